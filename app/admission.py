@@ -0,0 +1,147 @@
+import json
+import logging
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from fastapi import HTTPException, Request
+
+logger = logging.getLogger("pupero_transactions")
+
+# Admission configuration (0 disables a limit)
+_ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "true").strip().lower() not in {"0", "false", "no", "off"}
+_DEFAULT_MAX_INFLIGHT = int(os.getenv("ADMISSION_MAX_INFLIGHT", "32"))
+_DEFAULT_USER_RATE = float(os.getenv("ADMISSION_USER_RATE", "5"))  # tokens per second per user
+_DEFAULT_USER_BURST = float(os.getenv("ADMISSION_USER_BURST", "10"))
+_RETRY_AFTER_SECONDS = int(os.getenv("ADMISSION_RETRY_AFTER_SECONDS", "1"))
+_MAX_TRACKED_USERS = int(os.getenv("ADMISSION_MAX_TRACKED_USERS", "10000"))
+
+
+class _TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, burst: float, now: float):
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, rate: float, burst: float, now: float):
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+
+class EndpointGroup:
+    """Global in-flight cap plus per-user token buckets for one group of endpoints."""
+
+    def __init__(self, name: str, max_inflight: int, user_rate: float, user_burst: float, max_tracked_users: int = _MAX_TRACKED_USERS):
+        self.name = name
+        self.max_tracked_users = max(1, max_tracked_users)
+        self.max_inflight = max_inflight
+        self.user_rate = user_rate
+        self.user_burst = max(user_burst, 1.0)
+        self.inflight = 0
+        self.admitted = 0
+        self.shed_inflight = 0
+        self.shed_rate = 0
+        self._buckets: "OrderedDict[int, _TokenBucket]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def try_acquire(self, user_id: Optional[int], now: Optional[float] = None) -> tuple[int, int]:
+        """Reserve a slot. Returns (0, 0) when admitted, else (status_code, retry_after_seconds)."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if self.max_inflight > 0 and self.inflight >= self.max_inflight:
+                self.shed_inflight += 1
+                return 503, _RETRY_AFTER_SECONDS
+            if user_id is not None and self.user_rate > 0:
+                bucket = self._buckets.get(user_id)
+                if bucket is None:
+                    # LRU cap: evicting the least recently seen user is O(1) and keeps memory bounded
+                    while len(self._buckets) >= self.max_tracked_users:
+                        self._buckets.popitem(last=False)
+                    bucket = self._buckets[user_id] = _TokenBucket(self.user_burst, now)
+                else:
+                    self._buckets.move_to_end(user_id)
+                    bucket.refill(self.user_rate, self.user_burst, now)
+                if bucket.tokens < 1.0:
+                    self.shed_rate += 1
+                    return 429, max(1, math.ceil((1.0 - bucket.tokens) / self.user_rate))
+                bucket.tokens -= 1.0
+            self.inflight += 1
+            self.admitted += 1
+            return 0, 0
+
+    def release(self):
+        with self._lock:
+            self.inflight = max(0, self.inflight - 1)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "inflight": self.inflight,
+                "max_inflight": self.max_inflight,
+                "user_rate": self.user_rate,
+                "user_burst": self.user_burst,
+                "admitted": self.admitted,
+                "shed_inflight": self.shed_inflight,
+                "shed_rate": self.shed_rate,
+                "tracked_users": len(self._buckets),
+            }
+
+
+def _make_group(name: str) -> EndpointGroup:
+    key = name.upper()
+    return EndpointGroup(
+        name,
+        max_inflight=int(os.getenv(f"ADMISSION_MAX_INFLIGHT_{key}", str(_DEFAULT_MAX_INFLIGHT))),
+        user_rate=float(os.getenv(f"ADMISSION_USER_RATE_{key}", str(_DEFAULT_USER_RATE))),
+        user_burst=float(os.getenv(f"ADMISSION_USER_BURST_{key}", str(_DEFAULT_USER_BURST))),
+    )
+
+
+groups: dict[str, EndpointGroup] = {name: _make_group(name) for name in ("transfer", "reserve", "withdraw", "trade")}
+
+
+async def _user_from_request(request: Request, user_field: Optional[str]) -> Optional[int]:
+    if not user_field:
+        return None
+    val = request.path_params.get(user_field)
+    if val is None:
+        try:
+            body = await request.json()
+        except Exception:
+            return None
+        if isinstance(body, dict):
+            val = body.get(user_field)
+    try:
+        return int(val) if val is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def admit(group_name: str, user_field: Optional[str] = None):
+    """Route dependency: shed with 503 (group saturated) or 429 (user over rate) before any DB/RPC work."""
+    group = groups[group_name]
+
+    async def _admission(request: Request):
+        if not _ADMISSION_ENABLED:
+            yield
+            return
+        user_id = await _user_from_request(request, user_field)
+        status, retry_after = group.try_acquire(user_id)
+        if status:
+            logger.info(json.dumps({"event": "admission_shed", "group": group_name, "user_id": user_id, "status": status, "retry_after": retry_after}))
+            detail = "Too many requests for this user" if status == 429 else "Service busy, retry later"
+            raise HTTPException(status_code=status, detail=detail, headers={"Retry-After": str(retry_after)})
+        try:
+            yield
+        finally:
+            group.release()
+
+    return _admission
+
+
+def admission_stats() -> dict:
+    return {"enabled": _ADMISSION_ENABLED, "groups": {name: g.stats() for name, g in groups.items()}}
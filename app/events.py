@@ -0,0 +1,271 @@
+import asyncio
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Optional
+
+import pika
+
+logger = logging.getLogger("pupero_transactions")
+
+# Streaming configuration
+_EVENTS_BACKEND = os.getenv("EVENTS_BACKEND", "memory").strip().lower()  # "memory" or "rabbitmq"
+_EVENTS_EXCHANGE = os.getenv("EVENTS_EXCHANGE", "wallet.events")
+_EVENTS_BUFFER = int(os.getenv("EVENTS_SUBSCRIBER_BUFFER", "64"))
+_EVENTS_HEARTBEAT_SECONDS = float(os.getenv("EVENTS_HEARTBEAT_SECONDS", "15"))
+
+
+class _Subscriber:
+    def __init__(self, user_id: int, loop: asyncio.AbstractEventLoop, maxsize: int):
+        self.user_id = user_id
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self.dropped = 0
+
+    def offer(self, event: dict):
+        # Runs on the subscriber's loop. A slow client loses its oldest events, never blocks publishers.
+        if self.queue.full():
+            try:
+                self.queue.get_nowait()
+                self.dropped += 1
+            except asyncio.QueueEmpty:
+                pass
+        self.queue.put_nowait(event)
+
+
+class BalanceHub:
+    """In-process fan-out of balance/reservation events to per-user subscribers.
+    publish() is safe to call from sync handlers running in the threadpool; delivery
+    is handed to each subscriber's event loop with a bounded buffer.
+    """
+
+    def __init__(self, buffer_size: int = 64):
+        self.buffer_size = max(1, int(buffer_size))
+        self._subs: dict[int, set[_Subscriber]] = {}
+        self._lock = threading.Lock()
+        self.backend: "LocalBackend | RabbitBackend" = LocalBackend(self)
+
+    def subscribe(self, user_id: int) -> _Subscriber:
+        sub = _Subscriber(user_id, asyncio.get_running_loop(), self.buffer_size)
+        with self._lock:
+            self._subs.setdefault(user_id, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, sub: _Subscriber):
+        with self._lock:
+            subs = self._subs.get(sub.user_id)
+            if subs is not None:
+                subs.discard(sub)
+                if not subs:
+                    self._subs.pop(sub.user_id, None)
+
+    def subscriber_count(self, user_id: Optional[int] = None) -> int:
+        with self._lock:
+            if user_id is not None:
+                return len(self._subs.get(user_id, ()))
+            return sum(len(s) for s in self._subs.values())
+
+    def publish(self, event: dict):
+        """Broadcast an event through the configured backend. Never raises."""
+        try:
+            self.backend.publish(event)
+        except Exception as e:
+            logger.warning(json.dumps({"event": "balance_event_publish_failed", "error": str(e)}))
+
+    def deliver_local(self, event: dict):
+        user_id = event.get("user_id")
+        with self._lock:
+            subs = list(self._subs.get(user_id, ()))
+        for sub in subs:
+            try:
+                sub.loop.call_soon_threadsafe(sub.offer, event)
+            except RuntimeError:
+                # Subscriber's loop already closed; it will be removed on disconnect
+                pass
+
+
+class LocalBackend:
+    """Single-process backend: events only reach subscribers of this worker."""
+
+    def __init__(self, hub: BalanceHub):
+        self.hub = hub
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def publish(self, event: dict):
+        self.hub.deliver_local(event)
+
+
+class RabbitBackend:
+    """Fanout-exchange backend so every uvicorn worker sees every event.
+    Local delivery happens only via the broker (including our own publishes) to avoid duplicates.
+    publish() only enqueues: a single publisher thread owns the broker connection, reconnects with
+    backoff, and delivers locally while the broker is unreachable, so request handlers never wait on RabbitMQ.
+    """
+
+    def __init__(self, hub: BalanceHub, url: str, exchange: str, max_pending: int = 1000):
+        self.hub = hub
+        self.url = url
+        self.exchange = exchange
+        self.dropped = 0
+        self._pending: queue.Queue = queue.Queue(maxsize=max_pending)
+        self._thread: Optional[threading.Thread] = None
+        self._publisher: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._consumer_conn = None
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._consume_forever, name="balance-events-consumer", daemon=True)
+                self._thread.start()
+            if self._publisher is None:
+                self._publisher = threading.Thread(target=self._publish_forever, name="balance-events-publisher", daemon=True)
+                self._publisher.start()
+
+    def stop(self, timeout: float = 5.0):
+        """Stop the consumer and publisher threads (used on shutdown and in tests)."""
+        self._stopping.set()
+        conn = self._consumer_conn
+        if conn is not None:
+            try:
+                conn.add_callback_threadsafe(conn.close)
+            except Exception:
+                pass
+        try:
+            self._pending.put_nowait(None)  # wake the publisher
+        except queue.Full:
+            pass
+        for t in (self._thread, self._publisher):
+            if t is not None:
+                t.join(timeout)
+
+    def publish(self, event: dict):
+        if self._stopping.is_set():
+            self.hub.deliver_local(event)
+            return
+        if self._publisher is None:
+            self.start()
+        try:
+            self._pending.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+            logger.warning(json.dumps({"event": "balance_event_dropped", "exchange": self.exchange, "dropped": self.dropped}))
+
+    def _publish_forever(self):
+        connection = None
+        ch = None
+        retry_at = 0.0
+        while not self._stopping.is_set():
+            try:
+                event = self._pending.get(timeout=5.0)
+            except queue.Empty:
+                # Keep the idle connection's heartbeats serviced so the broker doesn't drop it
+                if connection is not None:
+                    try:
+                        connection.process_data_events(time_limit=0)
+                    except Exception:
+                        connection, ch = None, None
+                continue
+            if event is None:
+                continue
+            if ch is None and time.monotonic() >= retry_at:
+                try:
+                    connection = pika.BlockingConnection(pika.URLParameters(self.url))
+                    ch = connection.channel()
+                    ch.exchange_declare(exchange=self.exchange, exchange_type="fanout", durable=True)
+                except Exception as e:
+                    logger.warning(json.dumps({"event": "balance_event_broadcast_connect_failed", "exchange": self.exchange, "error": str(e)}))
+                    connection, ch, retry_at = None, None, time.monotonic() + 2.0
+            if ch is None:
+                self.hub.deliver_local(event)
+                continue
+            try:
+                ch.basic_publish(exchange=self.exchange, routing_key="", body=json.dumps(event).encode("utf-8"))
+            except Exception as e:
+                logger.warning(json.dumps({"event": "balance_event_broadcast_failed", "exchange": self.exchange, "error": str(e)}))
+                try:
+                    connection.close()
+                except Exception:
+                    pass
+                connection, ch, retry_at = None, None, time.monotonic() + 2.0
+                self.hub.deliver_local(event)
+        if connection is not None:
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+    def _consume_forever(self):
+        while not self._stopping.is_set():
+            try:
+                connection = self._consumer_conn = pika.BlockingConnection(pika.URLParameters(self.url))
+                ch = connection.channel()
+                ch.exchange_declare(exchange=self.exchange, exchange_type="fanout", durable=True)
+                q = ch.queue_declare(queue="", exclusive=True, auto_delete=True)
+                ch.queue_bind(exchange=self.exchange, queue=q.method.queue)
+
+                def on_message(channel, method, properties, body):
+                    try:
+                        self.hub.deliver_local(json.loads(body.decode("utf-8")))
+                    except Exception as e:
+                        logger.info(json.dumps({"event": "balance_event_decode_error", "error": str(e)}))
+
+                ch.basic_consume(queue=q.method.queue, on_message_callback=on_message, auto_ack=True)
+                logger.info(json.dumps({"event": "balance_events_consumer_started", "exchange": self.exchange}))
+                ch.start_consuming()
+            except Exception as e:
+                if not self._stopping.is_set():
+                    logger.warning(json.dumps({"event": "balance_events_consumer_error", "exchange": self.exchange, "error": str(e)}))
+            self._consumer_conn = None
+            self._stopping.wait(2.0)
+
+
+def _make_hub() -> BalanceHub:
+    h = BalanceHub(buffer_size=_EVENTS_BUFFER)
+    rabbit_url = os.getenv("RABBITMQ_URL")
+    if _EVENTS_BACKEND == "rabbitmq":
+        if rabbit_url:
+            h.backend = RabbitBackend(h, rabbit_url, _EVENTS_EXCHANGE)
+        else:
+            logger.warning(json.dumps({"event": "balance_events_backend_fallback", "reason": "RABBITMQ_URL not set"}))
+    return h
+
+
+hub = _make_hub()
+
+
+def _sse(event_name: str, data: dict) -> str:
+    return f"event: {event_name}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+async def sse_stream(request, sub: _Subscriber, snapshot: Optional[dict] = None):
+    """Yield SSE frames for one subscriber until the client disconnects.
+    The caller subscribes before reading the snapshot, so changes committed in between are
+    queued rather than lost (at worst the client sees one event repeating the snapshot state).
+    Sends the snapshot first, then pushed events, with comment heartbeats while idle.
+    """
+    try:
+        if snapshot is not None:
+            yield _sse("balance", snapshot)
+        while True:
+            if await request.is_disconnected():
+                break
+            try:
+                event = await asyncio.wait_for(sub.queue.get(), timeout=_EVENTS_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            yield _sse(event.get("type", "balance"), event)
+    finally:
+        hub.unsubscribe(sub)
+        if sub.dropped:
+            logger.info(json.dumps({"event": "balance_stream_dropped_events", "user_id": sub.user_id, "dropped": sub.dropped}))
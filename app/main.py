@@ -1,5 +1,7 @@
 from fastapi import FastAPI, Depends, HTTPException, Body
-from sqlmodel import Session, select
+from fastapi.responses import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+from sqlmodel import Session, select, update
 from typing import Optional
 import os, sys
 import httpx
@@ -9,8 +11,10 @@ import urllib.parse
 from datetime import datetime
 from .database import get_session
 
-from .schemas import BalanceOut, BalanceSetRequest, BalanceAdjustRequest, TransferCreate, TransferOut, WithdrawRequest, WithdrawResponse, TradeCreate, TradeQueued, ReserveCreate, ReservationOut, ReservationCommitRequest
+from .schemas import BalanceOut, BalanceSetRequest, BalanceAdjustRequest, TransferCreate, TransferOut, WithdrawRequest, WithdrawResponse, TradeCreate, TradeQueued, ReserveCreate, ReservationOut, ReservationCommitRequest, ReservationBulkReleaseOut
 from .models import UserBalance, LedgerTx
+from .events import hub, sse_stream
+from .admission import admit, admission_stats
 
 app = FastAPI(title="Pupero Transactions Service")
 
@@ -112,6 +116,13 @@ def _ensure_balance(session: Session, user_id: int) -> UserBalance:
     return bal
 
 
+def _lock_balance(session: Session, user_id: int) -> UserBalance:
+    """Ensure the balance row exists, then re-read it with a row lock held until commit."""
+    _ensure_balance(session, user_id)
+    stmt = select(UserBalance).where(UserBalance.user_id == user_id).with_for_update().execution_options(populate_existing=True)
+    return session.exec(stmt).first()
+
+
 def _fetch_real_xmr(user_id: int) -> float | None:
     """Fetch user's real XMR by querying MoneroWalletManager via API.
     Behavior:
@@ -175,6 +186,44 @@ def _to_balance_out(b: UserBalance) -> BalanceOut:
     return BalanceOut(user_id=b.user_id, fake_xmr=b.fake_xmr, real_xmr=b.real_xmr, updated_at=b.updated_at)
 
 
+def _emit_balance(b: UserBalance, reason: str):
+    # Push the committed balance to stream subscribers; never fails the request
+    hub.publish({
+        "type": "balance",
+        "reason": reason,
+        "user_id": b.user_id,
+        "fake_xmr": b.fake_xmr,
+        "real_xmr": b.real_xmr,
+        "updated_at": b.updated_at.isoformat() if b.updated_at else None,
+    })
+
+
+def _reservation_event(tx: LedgerTx) -> dict:
+    return {
+        "type": "reservation",
+        "user_id": tx.from_user_id,
+        "reservation_id": tx.id,
+        "amount_xmr": tx.amount_xmr,
+        "status": tx.status,
+        "offer_id": tx.offer_id,
+        "trade_id": tx.trade_id,
+    }
+
+
+def _emit_reservation(tx: LedgerTx):
+    hub.publish(_reservation_event(tx))
+
+
+@app.on_event("startup")
+def _start_event_backend():
+    hub.backend.start()
+
+
+@app.on_event("shutdown")
+def _stop_event_backend():
+    hub.backend.stop()
+
+
 @app.get("/healthz")
 def healthz():
     return {"status": "ok"}
@@ -185,6 +234,12 @@ def health():
     return {"status": "ok"}
 
 
+@app.get("/admission/stats")
+def get_admission_stats():
+    """In-flight, admitted and shed counters per endpoint group."""
+    return admission_stats()
+
+
 @app.get("/balance/{user_id}", response_model=BalanceOut)
 def get_balance(user_id: int, session: Session = Depends(get_session)):
     bal = _ensure_balance(session, user_id)
@@ -195,9 +250,34 @@ def get_balance(user_id: int, session: Session = Depends(get_session)):
         session.add(bal)
         session.commit()
         session.refresh(bal)
+        _emit_balance(bal, "real_refresh")
     return _to_balance_out(bal)
 
 
+def _balance_snapshot(session: Session, user_id: int) -> dict:
+    bal = _ensure_balance(session, user_id)
+    return {"type": "balance", "reason": "snapshot", **json.loads(_to_balance_out(bal).model_dump_json())}
+
+
+@app.get("/balance/{user_id}/stream")
+async def stream_balance(user_id: int, request: Request, session: Session = Depends(get_session)):
+    """Server-sent events stream of balance and reservation changes for a user.
+    Emits the current balance first, then one event per committed change, so clients can stop polling.
+    """
+    # Subscribe before reading the snapshot so a change committed in between is still delivered
+    sub = hub.subscribe(user_id)
+    try:
+        snapshot = await run_in_threadpool(_balance_snapshot, session, user_id)
+    except Exception:
+        hub.unsubscribe(sub)
+        raise
+    return StreamingResponse(
+        sse_stream(request, sub, snapshot),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.post("/balance/{user_id}/set", response_model=BalanceOut)
 def set_balance(user_id: int, payload: BalanceSetRequest, session: Session = Depends(get_session)):
     bal = _ensure_balance(session, user_id)
@@ -212,6 +292,7 @@ def set_balance(user_id: int, payload: BalanceSetRequest, session: Session = Dep
         session.add(bal)
         session.commit()
         session.refresh(bal)
+        _emit_balance(bal, "set")
     return _to_balance_out(bal)
 
 
@@ -227,6 +308,7 @@ def increase_balance(user_id: int, payload: BalanceAdjustRequest, session: Sessi
     session.add(bal)
     session.commit()
     session.refresh(bal)
+    _emit_balance(bal, "increase")
     return _to_balance_out(bal)
 
 
@@ -246,10 +328,11 @@ def decrease_balance(user_id: int, payload: BalanceAdjustRequest, session: Sessi
     session.add(bal)
     session.commit()
     session.refresh(bal)
+    _emit_balance(bal, "decrease")
     return _to_balance_out(bal)
 
 
-@app.post("/transfer", response_model=TransferOut)
+@app.post("/transfer", response_model=TransferOut, dependencies=[Depends(admit("transfer", "from_user_id"))])
 def create_transfer(payload: TransferCreate = Body(...), session: Session = Depends(get_session)):
     if payload.amount_xmr <= 0:
         raise HTTPException(status_code=400, detail="Amount must be greater than zero")
@@ -271,74 +354,208 @@ def create_transfer(payload: TransferCreate = Body(...), session: Session = Depe
     session.commit()
     session.refresh(tx)
     logger.info(json.dumps({"event": "transfer_completed", "tx_id": tx.id, "from": tx.from_user_id, "to": tx.to_user_id, "amount": tx.amount_xmr}))
+    session.refresh(from_bal)
+    session.refresh(to_bal)
+    _emit_balance(from_bal, "transfer")
+    _emit_balance(to_bal, "transfer")
     # Return
     return TransferOut(id=tx.id, from_user_id=tx.from_user_id, to_user_id=tx.to_user_id, amount_xmr=tx.amount_xmr, status=tx.status, created_at=tx.created_at)
 
 
 # --- Escrow reservation endpoints ---
-@app.post("/reserve", response_model=ReservationOut)
+def _to_reservation_out(tx: LedgerTx) -> ReservationOut:
+    return ReservationOut(id=tx.id, seller_id=tx.from_user_id, amount_xmr=float(tx.amount_xmr), status=tx.status, created_at=tx.created_at, offer_id=tx.offer_id, trade_id=tx.trade_id)
+
+
+def _active_reservation_for_trade(session: Session, trade_id: str) -> LedgerTx | None:
+    stmt = select(LedgerTx).where(LedgerTx.trade_id == trade_id, LedgerTx.status == "reserved").order_by(LedgerTx.id.desc())
+    return session.exec(stmt).first()
+
+
+def _claim_reserved_tx(session: Session, tx: LedgerTx, new_status: str):
+    """Flip a reservation out of 'reserved' with a conditional UPDATE so only one caller can settle it.
+    Raises 409 (after rolling back) if another request already committed or released it.
+    """
+    result = session.exec(
+        update(LedgerTx)
+        .where(LedgerTx.id == tx.id, LedgerTx.status == "reserved")
+        .values(status=new_status)
+    )
+    if result.rowcount != 1:
+        session.rollback()
+        logger.info(json.dumps({"event": "reservation_settle_conflict", "tx_id": tx.id, "status": new_status}))
+        raise HTTPException(status_code=409, detail="Reservation was already committed or released")
+
+
+def _commit_reserved_tx(session: Session, tx: LedgerTx, to_user_id: int) -> ReservationOut:
+    amt = float(tx.amount_xmr)
+    # Lock the buyer's balance before claiming, so no intermediate commit can split the two writes
+    to_bal = _lock_balance(session, to_user_id)
+    _claim_reserved_tx(session, tx, "committed")
+    # Credit buyer's balance
+    to_bal.fake_xmr = float(to_bal.fake_xmr) + amt
+    session.add(to_bal)
+    # Also record a final ledger entry for the actual transfer for auditability
+    final_tx = LedgerTx(from_user_id=tx.from_user_id, to_user_id=to_user_id, amount_xmr=amt, status="completed", offer_id=tx.offer_id, trade_id=tx.trade_id)
+    session.add(final_tx)
+    session.commit()
+    session.refresh(tx)
+    logger.info(json.dumps({"event": "reservation_committed", "tx_id": tx.id, "trade_id": tx.trade_id, "buyer_id": to_user_id, "amount": amt}))
+    session.refresh(to_bal)
+    _emit_balance(to_bal, "reservation_commit")
+    _emit_reservation(tx)
+    return _to_reservation_out(tx)
+
+
+def _release_reserved_tx(session: Session, tx: LedgerTx) -> ReservationOut:
+    amt = float(tx.amount_xmr)
+    bal = _lock_balance(session, tx.from_user_id)
+    _claim_reserved_tx(session, tx, "released")
+    # Return funds to seller
+    bal.fake_xmr = float(bal.fake_xmr) + amt
+    session.add(bal)
+    session.commit()
+    session.refresh(tx)
+    logger.info(json.dumps({"event": "reservation_released", "tx_id": tx.id, "trade_id": tx.trade_id, "seller_id": tx.from_user_id, "amount": amt}))
+    session.refresh(bal)
+    _emit_balance(bal, "reservation_release")
+    _emit_reservation(tx)
+    return _to_reservation_out(tx)
+
+
+@app.post("/reserve", response_model=ReservationOut, dependencies=[Depends(admit("reserve", "seller_id"))])
 def create_reservation(payload: ReserveCreate = Body(...), session: Session = Depends(get_session)):
     if payload.amount_xmr is None or payload.amount_xmr <= 0:
         raise HTTPException(status_code=400, detail="Amount must be greater than zero")
-    bal = _ensure_balance(session, payload.seller_id)
     amt = float(payload.amount_xmr)
+    # Lock the seller's balance row first so concurrent reserves for the same trade serialize on it
+    bal = _lock_balance(session, payload.seller_id)
+    # Idempotent per trade: re-reserving an active trade returns the existing hold instead of locking funds twice
+    if payload.trade_id:
+        existing = _active_reservation_for_trade(session, payload.trade_id)
+        if existing:
+            out = _to_reservation_out(existing)
+            session.rollback()
+            if out.seller_id != payload.seller_id or abs(out.amount_xmr - amt) > 1e-12:
+                logger.info(json.dumps({"event": "reservation_conflict", "tx_id": out.id, "trade_id": payload.trade_id, "seller_id": payload.seller_id, "amount": amt}))
+                raise HTTPException(status_code=409, detail="Trade already has an active reservation with a different seller or amount")
+            logger.info(json.dumps({"event": "reservation_exists", "tx_id": out.id, "trade_id": payload.trade_id}))
+            return out
     if (bal.fake_xmr or 0.0) < amt:
         logger.info(json.dumps({"event": "reservation_failed_insufficient_funds", "seller_id": payload.seller_id, "amount": amt}))
         raise HTTPException(status_code=400, detail="Insufficient fake balance")
     # Decrease available balance and create a reserved ledger entry to escrow (user_id 0)
     bal.fake_xmr = float(bal.fake_xmr) - amt
     session.add(bal)
-    tx = LedgerTx(from_user_id=payload.seller_id, to_user_id=0, amount_xmr=amt, status="reserved")
+    tx = LedgerTx(from_user_id=payload.seller_id, to_user_id=0, amount_xmr=amt, status="reserved", offer_id=payload.offer_id, trade_id=payload.trade_id)
     session.add(tx)
     session.commit()
     session.refresh(tx)
-    logger.info(json.dumps({"event": "reservation_created", "tx_id": tx.id, "seller_id": payload.seller_id, "amount": amt}))
-    return ReservationOut(id=tx.id, seller_id=payload.seller_id, amount_xmr=amt, status=tx.status, created_at=tx.created_at)
+    logger.info(json.dumps({"event": "reservation_created", "tx_id": tx.id, "seller_id": payload.seller_id, "offer_id": payload.offer_id, "trade_id": payload.trade_id, "amount": amt}))
+    session.refresh(bal)
+    _emit_balance(bal, "reserve")
+    _emit_reservation(tx)
+    return _to_reservation_out(tx)
+
+
+@app.get("/reserve/by-trade/{trade_id}", response_model=ReservationOut)
+def get_reservation_by_trade(trade_id: str, session: Session = Depends(get_session)):
+    """Latest escrow reservation for a trade (any status)."""
+    stmt = select(LedgerTx).where(LedgerTx.trade_id == trade_id, LedgerTx.to_user_id == 0).order_by(LedgerTx.id.desc())
+    tx = session.exec(stmt).first()
+    if not tx:
+        raise HTTPException(status_code=404, detail="Reservation not found")
+    return _to_reservation_out(tx)
 
 
-@app.post("/reserve/{reservation_id}/commit", response_model=ReservationOut)
+@app.get("/reserve/by-offer/{offer_id}", response_model=list[ReservationOut])
+def list_reservations_by_offer(offer_id: str, status: Optional[str] = None, session: Session = Depends(get_session)):
+    """Escrow reservations for an offer, optionally filtered by status (e.g. reserved)."""
+    stmt = select(LedgerTx).where(LedgerTx.offer_id == offer_id, LedgerTx.to_user_id == 0)
+    if status:
+        stmt = stmt.where(LedgerTx.status == status)
+    rows = session.exec(stmt.order_by(LedgerTx.id)).all()
+    return [_to_reservation_out(tx) for tx in rows]
+
+
+@app.post("/reserve/{reservation_id}/commit", response_model=ReservationOut, dependencies=[Depends(admit("reserve"))])
 def commit_reservation(reservation_id: int, payload: ReservationCommitRequest = Body(...), session: Session = Depends(get_session)):
     tx = session.get(LedgerTx, reservation_id)
     if not tx or tx.status != "reserved":
         logger.info(json.dumps({"event": "reservation_commit_failed_not_found", "tx_id": reservation_id}))
         raise HTTPException(status_code=404, detail="Reservation not found or not reservable")
-    # Credit buyer's balance
-    to_bal = _ensure_balance(session, payload.to_user_id)
-    amt = float(tx.amount_xmr)
-    to_bal.fake_xmr = float(to_bal.fake_xmr) + amt
-    tx.status = "committed"
-    session.add(to_bal)
-    # Also record a final ledger entry for the actual transfer for auditability
-    final_tx = LedgerTx(from_user_id=tx.from_user_id, to_user_id=payload.to_user_id, amount_xmr=amt, status="completed")
-    session.add(tx)
-    session.add(final_tx)
-    session.commit()
-    session.refresh(tx)
-    logger.info(json.dumps({"event": "reservation_committed", "tx_id": tx.id, "buyer_id": payload.to_user_id, "amount": amt}))
-    return ReservationOut(id=tx.id, seller_id=tx.from_user_id, amount_xmr=amt, status=tx.status, created_at=tx.created_at)
+    return _commit_reserved_tx(session, tx, payload.to_user_id)
 
 
-@app.post("/reserve/{reservation_id}/release", response_model=ReservationOut)
+@app.post("/reserve/{reservation_id}/release", response_model=ReservationOut, dependencies=[Depends(admit("reserve"))])
 def release_reservation(reservation_id: int, session: Session = Depends(get_session)):
     tx = session.get(LedgerTx, reservation_id)
     if not tx or tx.status != "reserved":
         logger.info(json.dumps({"event": "reservation_release_failed_not_found", "tx_id": reservation_id}))
         raise HTTPException(status_code=404, detail="Reservation not found or not releasable")
-    # Return funds to seller
-    bal = _ensure_balance(session, tx.from_user_id)
-    amt = float(tx.amount_xmr)
-    bal.fake_xmr = float(bal.fake_xmr) + amt
-    tx.status = "released"
-    session.add(bal)
-    session.add(tx)
+    return _release_reserved_tx(session, tx)
+
+
+@app.post("/reserve/by-trade/{trade_id}/commit", response_model=ReservationOut, dependencies=[Depends(admit("reserve"))])
+def commit_reservation_by_trade(trade_id: str, payload: ReservationCommitRequest = Body(...), session: Session = Depends(get_session)):
+    tx = _active_reservation_for_trade(session, trade_id)
+    if not tx:
+        logger.info(json.dumps({"event": "reservation_commit_failed_not_found", "trade_id": trade_id}))
+        raise HTTPException(status_code=404, detail="Reservation not found or not reservable")
+    return _commit_reserved_tx(session, tx, payload.to_user_id)
+
+
+@app.post("/reserve/by-trade/{trade_id}/release", response_model=ReservationOut, dependencies=[Depends(admit("reserve"))])
+def release_reservation_by_trade(trade_id: str, session: Session = Depends(get_session)):
+    tx = _active_reservation_for_trade(session, trade_id)
+    if not tx:
+        logger.info(json.dumps({"event": "reservation_release_failed_not_found", "trade_id": trade_id}))
+        raise HTTPException(status_code=404, detail="Reservation not found or not releasable")
+    return _release_reserved_tx(session, tx)
+
+
+@app.post("/reserve/by-offer/{offer_id}/release", response_model=ReservationBulkReleaseOut, dependencies=[Depends(admit("reserve"))])
+def release_reservations_by_offer(offer_id: str, session: Session = Depends(get_session)):
+    """Release every active reservation of an offer (e.g. offer cancelled).
+    Ledger rows flip to released in a single UPDATE; sellers are refunded per aggregated amount.
+    """
+    stmt = select(LedgerTx).where(LedgerTx.offer_id == offer_id, LedgerTx.status == "reserved").with_for_update()
+    rows = session.exec(stmt).all()
+    if not rows:
+        return ReservationBulkReleaseOut(offer_id=offer_id, released=0, amount_xmr=0.0, reservation_ids=[])
+    ids = [tx.id for tx in rows]
+    refunds: dict[int, float] = {}
+    for tx in rows:
+        refunds[tx.from_user_id] = refunds.get(tx.from_user_id, 0.0) + float(tx.amount_xmr)
+    result = session.exec(
+        update(LedgerTx)
+        .where(LedgerTx.id.in_(ids), LedgerTx.status == "reserved")
+        .values(status="released")
+    )
+    if result.rowcount != len(ids):
+        session.rollback()
+        raise HTTPException(status_code=409, detail="Reservations changed concurrently; retry")
+    balances = []
+    for seller_id, amt in refunds.items():
+        bal = _ensure_balance(session, seller_id)
+        bal.fake_xmr = float(bal.fake_xmr) + amt
+        session.add(bal)
+        balances.append(bal)
+    # Snapshot events before commit expires the rows (the UPDATE already synced their status in-session)
+    events = [_reservation_event(tx) for tx in rows]
     session.commit()
-    session.refresh(tx)
-    logger.info(json.dumps({"event": "reservation_released", "tx_id": tx.id, "seller_id": tx.from_user_id, "amount": amt}))
-    return ReservationOut(id=tx.id, seller_id=tx.from_user_id, amount_xmr=amt, status=tx.status, created_at=tx.created_at)
+    total = sum(refunds.values())
+    logger.info(json.dumps({"event": "reservations_released_by_offer", "offer_id": offer_id, "count": len(ids), "amount": total}))
+    for bal in balances:
+        session.refresh(bal)
+        _emit_balance(bal, "reservation_release")
+    for event in events:
+        hub.publish(event)
+    return ReservationBulkReleaseOut(offer_id=offer_id, released=len(ids), amount_xmr=total, reservation_ids=ids)
 
 
 # New trading endpoint: enqueue trade to RabbitMQ only (no immediate balance mutation)
-@app.post("/trade", response_model=TradeQueued)
+@app.post("/trade", response_model=TradeQueued, dependencies=[Depends(admit("trade", "buyer_id"))])
 def create_trade(payload: TradeCreate = Body(...)):
     if payload.amount_xmr <= 0:
         raise HTTPException(status_code=400, detail="Amount must be greater than zero")
@@ -377,6 +594,7 @@ def refresh_balance(user_id: int, session: Session = Depends(get_session)):
             session.add(bal)
             session.commit()
             session.refresh(bal)
+            _emit_balance(bal, "real_refresh")
         logger.info(json.dumps({"event": "balance_refresh", "user_id": user_id, "real_xmr": real}))
     else:
         logger.info(json.dumps({"event": "balance_refresh_no_update", "user_id": user_id}))
@@ -384,7 +602,7 @@ def refresh_balance(user_id: int, session: Session = Depends(get_session)):
 
 
 # --- Withdrawal endpoint ---
-@app.post("/withdraw/{user_id}", response_model=WithdrawResponse)
+@app.post("/withdraw/{user_id}", response_model=WithdrawResponse, dependencies=[Depends(admit("withdraw", "user_id"))])
 def withdraw(user_id: int, payload: WithdrawRequest = Body(...), session: Session = Depends(get_session)):
     # Validate amount
     if payload.amount_xmr is None or payload.amount_xmr <= 0:
@@ -398,6 +616,7 @@ def withdraw(user_id: int, payload: WithdrawRequest = Body(...), session: Sessio
         session.add(bal)
         session.commit()
         session.refresh(bal)
+        _emit_balance(bal, "real_refresh")
 
     total_available = float(bal.fake_xmr or 0.0) + float(bal.real_xmr or 0.0)
     amt = float(payload.amount_xmr)
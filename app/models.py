@@ -18,4 +18,7 @@ class LedgerTx(SQLModel, table=True):
     to_user_id: int = Field(index=True)
     amount_xmr: float
     status: str = Field(default="completed", index=True)
+    # Escrow context from the Offers/Trades services; lets callers find reservations without keeping our id
+    offer_id: Optional[str] = Field(default=None, max_length=64, index=True)
+    trade_id: Optional[str] = Field(default=None, max_length=64, index=True)
     created_at: datetime = Field(default_factory=datetime.utcnow, sa_column_kwargs={"server_default": func.current_timestamp()}, index=True)
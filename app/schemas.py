@@ -1,4 +1,4 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from typing import Optional
 from datetime import datetime
 
@@ -118,8 +118,8 @@ class WithdrawResponse(BaseModel):
 class ReserveCreate(BaseModel):
     seller_id: int
     amount_xmr: float
-    offer_id: Optional[str] = None
-    trade_id: Optional[str] = None
+    offer_id: Optional[str] = Field(default=None, max_length=64)  # matches ledgertx.offer_id VARCHAR(64)
+    trade_id: Optional[str] = Field(default=None, max_length=64)
 
 class ReservationOut(BaseModel):
     id: int
@@ -127,6 +127,14 @@ class ReservationOut(BaseModel):
     amount_xmr: float
     status: str
     created_at: datetime
+    offer_id: Optional[str] = None
+    trade_id: Optional[str] = None
 
 class ReservationCommitRequest(BaseModel):
     to_user_id: int
+
+class ReservationBulkReleaseOut(BaseModel):
+    offer_id: str
+    released: int
+    amount_xmr: float
+    reservation_ids: list[int]
@@ -0,0 +1,32 @@
+import pytest
+from fastapi.testclient import TestClient
+from sqlmodel import SQLModel, Session, create_engine
+
+import app.admission as admission
+import app.main as mainmod
+from app.database import get_session
+from app.main import app
+
+
+@pytest.fixture
+def engine(tmp_path):
+    eng = create_engine(f"sqlite:///{tmp_path}/transactions.db", connect_args={"check_same_thread": False})
+    SQLModel.metadata.create_all(eng)
+    yield eng
+    eng.dispose()
+
+
+@pytest.fixture
+def client(engine, monkeypatch):
+    """TestClient on a fresh SQLite schema, without Monero lookups or admission limits."""
+    def _session():
+        with Session(engine) as session:
+            yield session
+
+    monkeypatch.setattr(mainmod, "_fetch_real_xmr", lambda user_id: None)
+    monkeypatch.setattr(admission, "_ADMISSION_ENABLED", False)
+    app.dependency_overrides[get_session] = _session
+    try:
+        yield TestClient(app)
+    finally:
+        app.dependency_overrides.pop(get_session, None)
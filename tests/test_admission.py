@@ -0,0 +1,130 @@
+import pytest
+from fastapi.testclient import TestClient
+
+import app.admission as admission
+import app.main as mainmod
+from app.admission import EndpointGroup
+
+
+def test_inflight_cap_sheds_with_503():
+    g = EndpointGroup("test", max_inflight=2, user_rate=0, user_burst=1)
+    assert g.try_acquire(None) == (0, 0)
+    assert g.try_acquire(None) == (0, 0)
+    status, retry_after = g.try_acquire(None)
+    assert status == 503 and retry_after >= 1
+    g.release()
+    assert g.try_acquire(None) == (0, 0)
+    assert g.stats()["shed_inflight"] == 1
+
+
+def test_user_token_bucket_sheds_with_429_and_refills():
+    g = EndpointGroup("test", max_inflight=0, user_rate=1.0, user_burst=2)
+    now = 100.0
+    assert g.try_acquire(1, now)[0] == 0
+    assert g.try_acquire(1, now)[0] == 0
+    status, retry_after = g.try_acquire(1, now)
+    assert status == 429 and retry_after == 1
+    # Other users have their own bucket
+    assert g.try_acquire(2, now)[0] == 0
+    # One second later one token is back
+    assert g.try_acquire(1, now + 1.0)[0] == 0
+    assert g.stats()["shed_rate"] == 1
+
+
+def test_tracked_users_capped_with_lru_eviction():
+    g = EndpointGroup("test", max_inflight=0, user_rate=1.0, user_burst=1, max_tracked_users=3)
+    now = 100.0
+    for uid in (1, 2, 3):
+        assert g.try_acquire(uid, now)[0] == 0
+    # User 1 is touched again (and throttled), so user 2 becomes least recently seen
+    assert g.try_acquire(1, now)[0] == 429
+    for uid in range(4, 1000):
+        g.try_acquire(uid, now)
+    assert g.stats()["tracked_users"] == 3
+
+
+# --- End-to-end through the route dependency ---
+
+
+@pytest.fixture
+def limited(client, monkeypatch):
+    """Enable admission and give each group fresh counters; returns a setter for group limits."""
+    monkeypatch.setattr(admission, "_ADMISSION_ENABLED", True)
+    for g in admission.groups.values():
+        for attr in ("inflight", "admitted", "shed_inflight", "shed_rate"):
+            monkeypatch.setattr(g, attr, 0)
+        monkeypatch.setattr(g, "_buckets", type(g._buckets)())
+
+    def configure(name, max_inflight=0, user_rate=0.0, user_burst=1.0):
+        g = admission.groups[name]
+        monkeypatch.setattr(g, "max_inflight", max_inflight)
+        monkeypatch.setattr(g, "user_rate", user_rate)
+        monkeypatch.setattr(g, "user_burst", user_burst)
+        return g
+
+    return configure
+
+
+def test_user_over_rate_gets_429_with_retry_after(client, limited):
+    limited("transfer", user_rate=0.5, user_burst=2)
+    client.post("/balance/1/increase", json={"amount_xmr": 10})
+    body = {"from_user_id": 1, "to_user_id": 2, "amount_xmr": 1}
+    assert client.post("/transfer", json=body).status_code == 200
+    assert client.post("/transfer", json=body).status_code == 200
+    r = client.post("/transfer", json=body)
+    assert r.status_code == 429
+    assert int(r.headers["Retry-After"]) >= 1
+    # Another sender is unaffected
+    assert client.post("/transfer", json={"from_user_id": 3, "to_user_id": 2, "amount_xmr": 1}).status_code == 400
+
+
+def test_trade_is_limited_per_buyer(client, limited, monkeypatch):
+    limited("trade", user_rate=0.5, user_burst=1)
+    monkeypatch.setattr(mainmod, "_publish_queue", lambda msg, queue_name: None)
+    assert client.post("/trade", json={"seller_id": 1, "buyer_id": 2, "amount_xmr": 1}).status_code == 200
+    assert client.post("/trade", json={"seller_id": 1, "buyer_id": 3, "amount_xmr": 1}).status_code == 200
+    assert client.post("/trade", json={"seller_id": 1, "buyer_id": 2, "amount_xmr": 1}).status_code == 429
+
+
+def test_full_group_gets_503_before_handler_runs(client, limited, monkeypatch):
+    g = limited("withdraw", max_inflight=1)
+    monkeypatch.setattr(g, "inflight", 1)
+    touched = []
+    monkeypatch.setattr(mainmod, "_ensure_balance", lambda session, user_id: touched.append(user_id))
+    r = client.post("/withdraw/1", json={"to_address": "4...", "amount_xmr": 0.1})
+    assert r.status_code == 503
+    assert r.headers["Retry-After"] == str(admission._RETRY_AFTER_SECONDS)
+    assert touched == []
+    assert g.inflight == 1
+
+
+def test_inflight_released_after_success_and_errors(client, limited, monkeypatch):
+    g = limited("transfer", max_inflight=4)
+    client.post("/balance/1/increase", json={"amount_xmr": 10})
+    assert client.post("/transfer", json={"from_user_id": 1, "to_user_id": 2, "amount_xmr": 1}).status_code == 200
+    assert g.inflight == 0
+    assert client.post("/transfer", json={"from_user_id": 1, "to_user_id": 2, "amount_xmr": 100}).status_code == 400
+    assert g.inflight == 0
+
+    def boom(session, user_id):
+        raise RuntimeError("db down")
+    monkeypatch.setattr(mainmod, "_ensure_balance", boom)
+    r = TestClient(mainmod.app, raise_server_exceptions=False).post("/transfer", json={"from_user_id": 1, "to_user_id": 2, "amount_xmr": 1})
+    assert r.status_code == 500
+    assert g.inflight == 0
+    assert g.stats()["admitted"] == 3
+
+
+def test_stats_report_shed_counts(client, limited, monkeypatch):
+    limited("reserve", user_rate=0.5, user_burst=1)
+    g = limited("withdraw", max_inflight=1)
+    monkeypatch.setattr(g, "inflight", 1)
+    client.post("/balance/1/increase", json={"amount_xmr": 10})
+    client.post("/reserve", json={"seller_id": 1, "amount_xmr": 1})
+    assert client.post("/reserve", json={"seller_id": 1, "amount_xmr": 1}).status_code == 429
+    assert client.post("/withdraw/1", json={"to_address": "4...", "amount_xmr": 0.1}).status_code == 503
+    stats = client.get("/admission/stats").json()
+    assert stats["enabled"] is True
+    assert stats["groups"]["reserve"]["shed_rate"] == 1
+    assert stats["groups"]["reserve"]["admitted"] == 1
+    assert stats["groups"]["withdraw"]["shed_inflight"] == 1
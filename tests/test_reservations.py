@@ -0,0 +1,129 @@
+import pytest
+from fastapi import HTTPException
+from sqlmodel import Session
+
+from app.main import _active_reservation_for_trade, _commit_reserved_tx, _release_reserved_tx
+
+
+def _fund(client, user_id, amount):
+    r = client.post(f"/balance/{user_id}/increase", json={"amount_xmr": amount})
+    assert r.status_code == 200
+
+
+def _fake(client, user_id):
+    return client.get(f"/balance/{user_id}").json()["fake_xmr"]
+
+
+def test_duplicate_reserve_returns_same_hold_without_charging_again(client):
+    _fund(client, 1, 10)
+    payload = {"seller_id": 1, "amount_xmr": 2, "offer_id": "OF1", "trade_id": "T1"}
+    first = client.post("/reserve", json=payload)
+    second = client.post("/reserve", json=payload)
+    assert first.status_code == 200 and second.status_code == 200
+    assert first.json()["id"] == second.json()["id"]
+    assert second.json()["trade_id"] == "T1" and second.json()["offer_id"] == "OF1"
+    assert _fake(client, 1) == 8.0
+
+
+def test_reserve_same_trade_with_different_terms_conflicts(client):
+    _fund(client, 1, 10)
+    _fund(client, 2, 10)
+    client.post("/reserve", json={"seller_id": 1, "amount_xmr": 1, "trade_id": "T1"})
+    r = client.post("/reserve", json={"seller_id": 1, "amount_xmr": 5, "trade_id": "T1"})
+    assert r.status_code == 409
+    r = client.post("/reserve", json={"seller_id": 2, "amount_xmr": 1, "trade_id": "T1"})
+    assert r.status_code == 409
+    assert _fake(client, 1) == 9.0
+    assert _fake(client, 2) == 10.0
+
+
+def test_commit_and_release_by_trade(client):
+    _fund(client, 1, 10)
+    client.post("/reserve", json={"seller_id": 1, "amount_xmr": 3, "trade_id": "T1"})
+    client.post("/reserve", json={"seller_id": 1, "amount_xmr": 2, "trade_id": "T2"})
+
+    r = client.post("/reserve/by-trade/T1/commit", json={"to_user_id": 5})
+    assert r.status_code == 200 and r.json()["status"] == "committed"
+    assert _fake(client, 5) == 3.0
+    assert client.post("/reserve/by-trade/T1/commit", json={"to_user_id": 5}).status_code == 404
+
+    r = client.post("/reserve/by-trade/T2/release")
+    assert r.status_code == 200 and r.json()["status"] == "released"
+    assert _fake(client, 1) == 7.0
+    assert client.post("/reserve/by-trade/T2/release").status_code == 404
+
+    assert client.get("/reserve/by-trade/T1").json()["status"] == "committed"
+    assert client.get("/reserve/by-trade/missing").status_code == 404
+
+
+def test_release_by_offer_refunds_sellers_and_skips_committed(client):
+    _fund(client, 1, 10)
+    _fund(client, 3, 10)
+    a = client.post("/reserve", json={"seller_id": 1, "amount_xmr": 2, "offer_id": "OF1", "trade_id": "T1"}).json()
+    b = client.post("/reserve", json={"seller_id": 1, "amount_xmr": 1, "offer_id": "OF1", "trade_id": "T2"}).json()
+    c = client.post("/reserve", json={"seller_id": 3, "amount_xmr": 4, "offer_id": "OF1", "trade_id": "T3"}).json()
+    other = client.post("/reserve", json={"seller_id": 3, "amount_xmr": 1, "offer_id": "OF2", "trade_id": "T4"}).json()
+    client.post("/reserve/by-trade/T2/commit", json={"to_user_id": 5})
+
+    assert len(client.get("/reserve/by-offer/OF1").json()) == 3
+    assert {r["id"] for r in client.get("/reserve/by-offer/OF1", params={"status": "reserved"}).json()} == {a["id"], c["id"]}
+
+    r = client.post("/reserve/by-offer/OF1/release")
+    assert r.status_code == 200
+    data = r.json()
+    assert data["released"] == 2 and data["amount_xmr"] == 6.0
+    assert sorted(data["reservation_ids"]) == sorted([a["id"], c["id"]])
+    assert _fake(client, 1) == 9.0
+    assert _fake(client, 3) == 9.0
+    assert client.get("/reserve/by-trade/T2").json()["status"] == "committed"
+    assert client.get("/reserve/by-trade/T4").json()["id"] == other["id"]
+    assert client.get("/reserve/by-trade/T4").json()["status"] == "reserved"
+
+    again = client.post("/reserve/by-offer/OF1/release").json()
+    assert again["released"] == 0 and again["reservation_ids"] == []
+    assert _fake(client, 1) == 9.0
+
+
+def test_settle_after_bulk_release_changes_no_balance(client):
+    _fund(client, 1, 10)
+    a = client.post("/reserve", json={"seller_id": 1, "amount_xmr": 2, "offer_id": "OF1", "trade_id": "T1"}).json()
+    client.post("/reserve/by-offer/OF1/release")
+    assert _fake(client, 1) == 10.0
+
+    assert client.post("/reserve/by-trade/T1/commit", json={"to_user_id": 5}).status_code == 404
+    assert client.post("/reserve/by-trade/T1/release").status_code == 404
+    assert client.post(f"/reserve/{a['id']}/commit", json={"to_user_id": 5}).status_code == 404
+    assert client.post(f"/reserve/{a['id']}/release").status_code == 404
+    assert _fake(client, 1) == 10.0
+    assert _fake(client, 5) == 0.0
+
+
+def test_settle_with_stale_read_conflicts_without_moving_funds(client, engine):
+    # Simulates a by-trade commit/release that looked the row up just before a concurrent release
+    _fund(client, 1, 10)
+    client.post("/reserve", json={"seller_id": 1, "amount_xmr": 2, "offer_id": "OF1", "trade_id": "T1"})
+    with Session(engine) as session:
+        stale = _active_reservation_for_trade(session, "T1")
+        assert stale is not None
+        client.post("/reserve/by-offer/OF1/release")
+        with pytest.raises(HTTPException) as exc:
+            _commit_reserved_tx(session, stale, 5)
+        assert exc.value.status_code == 409
+    with Session(engine) as session:
+        client.post("/reserve", json={"seller_id": 1, "amount_xmr": 3, "trade_id": "T2"})
+        stale = _active_reservation_for_trade(session, "T2")
+        assert client.post("/reserve/by-trade/T2/release").status_code == 200
+        with pytest.raises(HTTPException) as exc:
+            _release_reserved_tx(session, stale)
+        assert exc.value.status_code == 409
+    assert _fake(client, 1) == 10.0
+    assert _fake(client, 5) == 0.0
+
+
+def test_reserve_rejects_ids_longer_than_column(client):
+    _fund(client, 1, 10)
+    r = client.post("/reserve", json={"seller_id": 1, "amount_xmr": 1, "trade_id": "T" * 65})
+    assert r.status_code == 422
+    r = client.post("/reserve", json={"seller_id": 1, "amount_xmr": 1, "offer_id": "O" * 65})
+    assert r.status_code == 422
+    assert _fake(client, 1) == 10.0